@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+上游容错压测脚本
+使用注入延迟的上游桩（不访问 DashScope），对比开启/关闭对冲请求时的尾延迟，
+并演示熔断器在上游持续失败时的快速失败行为
+
+用法：
+    uv run python bench_upstream.py [--requests 400] [--concurrency 8]
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from main import UpstreamGuard, UpstreamUnavailable
+
+
+def make_stub(slow_ratio: float, failure_ratio: float = 0.0):
+    """
+    构造一个注入延迟的上游桩：
+    - 大部分调用 80~150ms
+    - slow_ratio 比例的调用卡顿 2~3s（模拟 DashScope 长尾）
+    - failure_ratio 比例的调用直接报错
+    """
+    counter = {"calls": 0}
+
+    def stub(timeout):
+        counter["calls"] += 1
+        if random.random() < failure_ratio:
+            time.sleep(0.05)
+            raise ConnectionError("注入的上游连接错误")
+        latency = random.uniform(2.0, 3.0) if random.random() < slow_ratio else random.uniform(0.08, 0.15)
+        time.sleep(min(latency, timeout))
+        if latency > timeout:
+            raise TimeoutError("上游调用超时")
+        return b"ok"
+
+    return stub, counter
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+async def run(guard: UpstreamGuard, stub, total: int, concurrency: int, budget_ms: int):
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                await guard.call(stub, start + budget_ms / 1000)
+            except Exception:
+                errors += 1
+            latencies.append(time.monotonic() - start)
+
+    await asyncio.gather(*(one() for _ in range(total)))
+    return latencies, errors
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="上游对冲请求/熔断压测")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--slow-ratio", type=float, default=0.03)
+    parser.add_argument("--budget-ms", type=int, default=5000)
+    args = parser.parse_args()
+
+    print(f"{'模式':<8}{'p50':>8}{'p95':>8}{'p99':>8}{'错误':>6}{'上游调用':>10}{'对冲':>6}{'对冲胜出':>8}")
+    for hedge_enabled in (False, True):
+        random.seed(42)
+        stub, counter = make_stub(args.slow_ratio)
+        guard = UpstreamGuard("bench", hedge_enabled=hedge_enabled, hedge_delay_ms=300, failure_threshold=10**6)
+        latencies, errors = await run(guard, stub, args.requests, args.concurrency, args.budget_ms)
+        ms = [x * 1000 for x in latencies]
+        print(f"{'对冲' if hedge_enabled else '无对冲':<8}"
+              f"{percentile(ms, 50):>8.0f}{percentile(ms, 95):>8.0f}{percentile(ms, 99):>8.0f}"
+              f"{errors:>6}{counter['calls']:>10}{guard.stats['hedged']:>6}{guard.stats['hedge_wins']:>8}")
+
+    # 熔断演示：上游全部失败时，超过阈值后请求直接被拒绝而不再占用上游
+    stub, counter = make_stub(0.0, failure_ratio=1.0)
+    guard = UpstreamGuard("bench", hedge_enabled=False, failure_threshold=5, reset_seconds=30)
+    _, errors = await run(guard, stub, 50, 1, args.budget_ms)
+    print(f"\n熔断演示：50 次请求全部失败，实际上游调用 {counter['calls']} 次，"
+          f"熔断拒绝 {guard.stats['rejected']} 次，熔断器状态 {guard.breaker.state}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
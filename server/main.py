@@ -5,11 +5,18 @@ FastAPI 服务器
 """
 import os
 import sys
+import time
+import secrets
+import threading
+import random
+from contextlib import contextmanager
 from pathlib import Path
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import StreamingResponse, Response
+from fastapi.responses import Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import asyncio
@@ -28,7 +35,7 @@ if env_path.exists():
 
 # 导入 DashScope（CosyVoice 和 Qwen 通过 DashScope 提供）
 import dashscope
-from dashscope.audio.tts_v2 import SpeechSynthesizer
+from dashscope.audio.tts_v2 import SpeechSynthesizer, AudioFormat
 
 # 导入 httpx（用于流式下载音频）
 import httpx
@@ -38,7 +45,7 @@ import httpx
 # from memori import Memori
 
 # 导入 OpenAI 客户端（用于 DashScope 兼容接口）
-from openai import OpenAI
+from openai import OpenAI, APIConnectionError, APIStatusError
 
 # 获取项目根目录
 # 在 PyInstaller 打包后的环境中，使用 sys._MEIPASS 获取资源路径
@@ -75,6 +82,35 @@ DASHSCOPE_API_KEY = os.getenv("DASHSCOPE_API_KEY", "")
 COSYVOICE_MODEL = os.getenv("COSYVOICE_MODEL", "cosyvoice-v3-flash")
 COSYVOICE_VOICE = os.getenv("COSYVOICE_VOICE", "longanzhi_v3")
 COSYVOICE_SPEECH_RATE = float(os.getenv("COSYVOICE_SPEECH_RATE", "1.0"))  # 语速：1.0为默认正常语速
+TTS_DEFAULT_FORMAT = os.getenv("TTS_DEFAULT_FORMAT", "mp3").lower()  # 客户端未指定格式时使用的音频格式
+TTS_CACHE_SIZE = int(os.getenv("TTS_CACHE_SIZE", "256"))  # TTS 音频缓存条目上限（按 文本+格式 缓存）
+
+# 上游（DashScope）容错配置
+UPSTREAM_BUDGET_MS = int(os.getenv("UPSTREAM_BUDGET_MS", "8000"))  # 默认单请求时间预算（毫秒）
+UPSTREAM_MAX_BUDGET_MS = int(os.getenv("UPSTREAM_MAX_BUDGET_MS", "30000"))  # 客户端可申请的最大时间预算
+UPSTREAM_HEDGE_ENABLED = os.getenv("UPSTREAM_HEDGE_ENABLED", "true").lower() == "true"  # 是否启用对冲请求
+UPSTREAM_HEDGE_DELAY_MS = int(os.getenv("UPSTREAM_HEDGE_DELAY_MS", "1500"))  # 样本不足时的对冲等待时间
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))  # 连续失败多少次后熔断
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))  # 熔断后多久允许试探请求
+UPSTREAM_MAX_WORKERS = int(os.getenv("UPSTREAM_MAX_WORKERS", "32"))  # 上游阻塞调用专用线程数
+
+# 推测式预生成配置（根据当前手牌预先生成解说和语音）
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "false").lower() == "true"  # 是否启用预生成
+PREFETCH_TOP_K = int(os.getenv("PREFETCH_TOP_K", "2"))  # 每次预生成的候选卡牌数
+PREFETCH_TTL_SECONDS = float(os.getenv("PREFETCH_TTL_SECONDS", "90"))  # 预生成结果有效期
+PREFETCH_MAX_PER_MINUTE = int(os.getenv("PREFETCH_MAX_PER_MINUTE", "20"))  # 每分钟最多预生成多少条（上游花费预算）
+
+# 解说模型路由配置
+COMMENTARY_ROUTER_ENABLED = os.getenv("COMMENTARY_ROUTER_ENABLED", "true").lower() == "true"  # 是否启用模型路由
+# 可路由的模型，按 速度快 -> 质量高 排列
+COMMENTARY_MODELS = [m.strip() for m in os.getenv("COMMENTARY_MODELS", "qwen-turbo,qwen-plus,qwen-max").split(",") if m.strip()] or ["qwen-plus"]
+COMMENTARY_LATENCY_TARGET_MS = int(os.getenv("COMMENTARY_LATENCY_TARGET_MS", "2500"))  # 默认解说延迟目标
+COMMENTARY_HIGH_LOAD = int(os.getenv("COMMENTARY_HIGH_LOAD", "4"))  # 并发解说请求数达到该值时自动降级
+
+# 管理端点配置
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")  # 管理端点令牌（X-Admin-Token），未设置时管理端点禁用
+PROFILER_MAX_SECONDS = 60  # 单次采样的最长时间窗口
+PROFILER_LAG_THRESHOLD_MS = float(os.getenv("PROFILER_LAG_THRESHOLD_MS", "100"))  # 事件循环延迟超过该值视为卡顿
 
 # Memori 配置
 # 临时禁用 memori 库（打包时 tiktoken 编码问题）
@@ -175,20 +211,1030 @@ else:
     print("警告: 未设置 DASHSCOPE_API_KEY 环境变量，TTS 和文本生成功能将不可用")
 
 
+# ========== 上游容错（对冲请求 / 熔断 / 时间预算） ==========
+
+class UpstreamUnavailable(Exception):
+    """上游暂不可用：熔断打开或请求时间预算耗尽"""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UpstreamError(Exception):
+    """上游返回了无效结果（如 TTS 未返回音频），视为上游故障"""
+
+
+def is_upstream_failure(e: BaseException) -> bool:
+    """
+    是否为上游自身导致的失败（计入熔断）：连接错误、超时、5xx、无效结果
+    客户端参数错误（如 OpenAI 400）等不计入熔断，也不使用预设解说兜底
+    """
+    if isinstance(e, (UpstreamUnavailable, UpstreamError, TimeoutError, ConnectionError, APIConnectionError)):
+        return True
+    return isinstance(e, APIStatusError) and e.status_code >= 500
+
+
+class LatencyTracker:
+    """滑动窗口延迟统计，用于计算对冲触发点（p95）"""
+
+    def __init__(self, window: int = 200):
+        self.samples = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+
+class CircuitBreaker:
+    """
+    简单熔断器
+    closed -> 连续失败达到阈值 -> open -> 冷却结束 -> half_open（放行一个试探请求）
+    试探成功则恢复 closed，失败则重新 open
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.reset_seconds - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if self.retry_after() > 0:
+                return False
+            self.state = "half_open"
+            self.probe_in_flight = False
+        if self.state == "half_open":
+            if self.probe_in_flight:
+                return False
+            self.probe_in_flight = True
+        return True
+
+    def release_probe(self):
+        """试探请求被取消、未得出结果时释放试探名额，让下一个请求继续试探"""
+        self.probe_in_flight = False
+
+    def record_success(self):
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.probe_in_flight = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        self.probe_in_flight = False
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                print(f"[熔断] 连续失败 {self.consecutive_failures} 次，熔断 {self.reset_seconds}s")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+# 上游阻塞调用专用线程池：SDK 调用是同步阻塞的，且对冲会额外占用线程，
+# 不与默认线程池（CPU 核数 + 4）争抢，避免排队反而拉高尾延迟
+upstream_executor = ThreadPoolExecutor(max_workers=UPSTREAM_MAX_WORKERS, thread_name_prefix="upstream")
+
+
+class UpstreamGuard:
+    """
+    包装一次阻塞的上游调用（在线程池中执行）：
+    - 主请求超过历史 p95 仍未返回时，发出一个对冲（重复）请求，取先返回者；
+      主请求直接失败时不重试，本次调用失败
+    - 每次调用的超时取自请求剩余的时间预算
+    - 上游导致的连续失败（连接错误、5xx、按默认预算超时）达到阈值后熔断，
+      熔断期间直接抛出 UpstreamUnavailable
+    """
+
+    def __init__(self, name: str, hedge_enabled: bool = UPSTREAM_HEDGE_ENABLED,
+                 hedge_delay_ms: int = UPSTREAM_HEDGE_DELAY_MS, min_samples: int = 20,
+                 failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_seconds: float = CIRCUIT_RESET_SECONDS):
+        self.name = name
+        self.hedge_enabled = hedge_enabled
+        self.hedge_delay_ms = hedge_delay_ms
+        self.min_samples = min_samples
+        self.latency = LatencyTracker()
+        self.outcomes = deque(maxlen=50)  # 最近调用是否成功，用于计算错误率
+        self.breaker = CircuitBreaker(failure_threshold, reset_seconds)
+        self.stats = {"calls": 0, "successes": 0, "failures": 0, "timeouts": 0,
+                      "client_errors": 0, "rejected": 0, "hedged": 0, "hedge_wins": 0}
+
+    def error_rate(self) -> Optional[float]:
+        if not self.outcomes:
+            return None
+        return 1 - sum(self.outcomes) / len(self.outcomes)
+
+    def hedge_delay(self) -> float:
+        """对冲触发时间（秒）：样本足够时取 p95，否则使用配置的默认值"""
+        if len(self.latency.samples) >= self.min_samples:
+            return self.latency.percentile(95)
+        return self.hedge_delay_ms / 1000
+
+    async def call(self, fn, deadline: float, hedge: bool = True, caller_limited: bool = False):
+        """
+        执行 fn(timeout_seconds)，deadline 为 time.monotonic() 下的截止时间
+        hedge=False 时不发对冲请求（用于低优先级的后台调用）
+        caller_limited=True 表示 deadline 来自客户端声明的、短于默认值的预算：
+        此时超时是客户端预算不足，只计入 timeouts，不计入熔断
+        """
+        if deadline - time.monotonic() <= 0:
+            self.stats["timeouts"] += 1
+            raise UpstreamUnavailable(f"{self.name} 请求时间预算已耗尽")
+        if not self.breaker.allow():
+            self.stats["rejected"] += 1
+            raise UpstreamUnavailable(f"{self.name} 熔断中", retry_after=self.breaker.retry_after())
+
+        self.stats["calls"] += 1
+        start = time.monotonic()
+        hedge_at = start + self.hedge_delay()
+        loop = asyncio.get_running_loop()
+        primary = asyncio.ensure_future(loop.run_in_executor(upstream_executor, fn, deadline - start))
+        pending = {primary}
+        hedged = not (hedge and self.hedge_enabled) or self.breaker.state != "closed"
+        last_error = None
+
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                # 主请求超过 p95 仍未返回时发出对冲请求（主请求已失败时不重试）
+                if not hedged and primary in pending and now >= hedge_at:
+                    hedged = True
+                    self.stats["hedged"] += 1
+                    pending.add(asyncio.ensure_future(loop.run_in_executor(upstream_executor, fn, deadline - now)))
+                if not pending:
+                    break
+                wait_until = deadline if hedged else min(deadline, hedge_at)
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(0.0, wait_until - now), return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        self.latency.record(time.monotonic() - start)
+                        self.breaker.record_success()
+                        self.outcomes.append(True)
+                        self.stats["successes"] += 1
+                        if task is not primary:
+                            self.stats["hedge_wins"] += 1
+                        return task.result()
+                    last_error = task.exception()
+        except asyncio.CancelledError:
+            # 调用方被取消（如客户端断开）：既不算成功也不算失败，但要释放半开状态的试探名额
+            self.breaker.release_probe()
+            raise
+        finally:
+            # 线程中的调用无法取消，让落后的请求在后台结束并吞掉其异常
+            for task in pending:
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+        if last_error is not None and not pending:
+            if not is_upstream_failure(last_error):
+                # 客户端错误（如参数无效）与上游健康无关：不计入熔断，只释放试探名额
+                self.breaker.release_probe()
+                self.stats["client_errors"] += 1
+                raise last_error
+            self.breaker.record_failure()
+            self.outcomes.append(False)
+            self.stats["failures"] += 1
+            raise last_error
+        self.stats["timeouts"] += 1
+        if caller_limited:
+            self.breaker.release_probe()
+        else:
+            self.breaker.record_failure()
+            self.outcomes.append(False)
+        raise UpstreamUnavailable(f"{self.name} 超出时间预算（{(deadline - start) * 1000:.0f}ms）")
+
+    def snapshot(self) -> dict:
+        p50 = self.latency.percentile(50)
+        p95 = self.latency.percentile(95)
+        p99 = self.latency.percentile(99)
+        error_rate = self.error_rate()
+        return {
+            "circuit": self.breaker.state,
+            "consecutive_failures": self.breaker.consecutive_failures,
+            "error_rate": round(error_rate, 3) if error_rate is not None else None,
+            "hedge_delay_ms": round(self.hedge_delay() * 1000),
+            "latency_ms": {
+                "p50": round(p50 * 1000) if p50 is not None else None,
+                "p95": round(p95 * 1000) if p95 is not None else None,
+                "p99": round(p99 * 1000) if p99 is not None else None,
+                "samples": len(self.latency.samples),
+            },
+            **self.stats,
+        }
+
+
+class ModelRouter:
+    """
+    解说模型路由
+    每个模型有独立的 UpstreamGuard（延迟分位数、错误率、熔断），按以下顺序选择模型：
+    - 高光时刻（如 game_over）：升级为剩余时间预算内能完成的最高质量模型，都来不及时用最快的模型
+    - 高负载（并发解说请求数 >= COMMENTARY_HIGH_LOAD）：降级为最快的模型
+    - 其它情况：满足延迟目标的最快模型，延迟相同（如都未实测）时优先客户端指定的模型
+    只在 COMMENTARY_MODELS 中选择：客户端指定了未配置的模型时视为没有偏好；
+    熔断中或近期错误率过高的模型不参与选择
+    """
+
+    MAX_ERROR_RATE = 0.5
+
+    def __init__(self, models: list, high_load: int):
+        self.models = list(models)  # 按 速度快 -> 质量高 排列
+        self.high_load = high_load
+        self.guards = {model: UpstreamGuard(f"解说生成[{model}]") for model in self.models}
+        self.inflight = 0
+        self.decisions = deque(maxlen=50)
+        self.counts = {}
+
+    def guard(self, model: str) -> UpstreamGuard:
+        """已配置模型的 UpstreamGuard（只为 COMMENTARY_MODELS 创建）"""
+        return self.guards[model]
+
+    def resolve(self, requested: Optional[str]) -> str:
+        """将客户端指定的模型映射到已配置的模型：未配置时使用 qwen-plus（若已配置）或第一个模型"""
+        if requested in self.guards:
+            return requested
+        return "qwen-plus" if "qwen-plus" in self.guards else self.models[0]
+
+    def measured_latency(self, model: str) -> Optional[float]:
+        """模型实测的 p95 延迟（秒），样本不足时返回 None"""
+        latency = self.guard(model).latency
+        if len(latency.samples) < 5:
+            return None
+        return latency.percentile(95)
+
+    def estimated_latency(self, model: str) -> Optional[float]:
+        """
+        模型的延迟估计（秒）：有实测值时取 p95；
+        否则按配置顺序假设它不快于排在它前面的已测模型，前面都未测时返回 None
+        """
+        measured = self.measured_latency(model)
+        if measured is not None:
+            return measured
+        faster = [self.measured_latency(m) for m in self.models[:self.models.index(model)]]
+        faster = [x for x in faster if x is not None]
+        return max(faster) if faster else None
+
+    def healthy(self, model: str) -> bool:
+        guard = self.guard(model)
+        if guard.breaker.state == "open" and guard.breaker.retry_after() > 0:
+            return False
+        if guard.breaker.state == "half_open" and guard.breaker.probe_in_flight:
+            return False
+        error_rate = guard.error_rate()
+        return len(guard.outcomes) < 5 or error_rate <= self.MAX_ERROR_RATE
+
+    def choose(self, requested: Optional[str], target: float, budget: float, salient: bool) -> tuple:
+        """
+        选择模型，返回 (模型, 原因)
+        target 为延迟目标，budget 为剩余时间预算（秒）
+        """
+        if requested not in self.guards:
+            requested = None  # 未配置的模型视为没有偏好
+        if not COMMENTARY_ROUTER_ENABLED:
+            return self.resolve(requested), "fixed"
+
+        candidates = [m for m in self.models if self.healthy(m)]
+        if not candidates:
+            return self.resolve(requested), "no_healthy_model"
+
+        def fits(model, limit):
+            estimate = self.estimated_latency(model)
+            return estimate is None or estimate <= limit
+
+        def speed(model):
+            # 未实测的模型使用按配置顺序推得的估计值；估计相同时优先客户端指定的模型，其次按配置顺序
+            estimate = self.estimated_latency(model)
+            return (estimate if estimate is not None else 0.0, model != requested, self.models.index(model))
+
+        if salient:
+            for model in reversed(candidates):
+                if fits(model, budget):
+                    return model, "upgrade_salient"
+            return min(candidates, key=speed), "salient_fastest_available"
+        if self.inflight >= self.high_load:
+            # 降级只选择已实测的模型，避免把流量压到延迟未知（可能更慢更贵）的模型上
+            measured = [m for m in candidates if self.measured_latency(m) is not None]
+            if measured:
+                return min(measured, key=speed), "downgrade_load"
+        fitting = [m for m in candidates if fits(m, target)]
+        if fitting:
+            model = min(fitting, key=speed)
+            return model, "requested" if model == requested else "fastest_fit"
+        return min(candidates, key=speed), "fastest_available"
+
+    def route(self, requested: Optional[str], target_ms: int, deadline: float, salient: bool) -> tuple:
+        """选择模型并记录路由决策"""
+        model, reason = self.choose(requested, target_ms / 1000, deadline - time.monotonic(), salient)
+        self.decisions.append({
+            "at": round(time.time(), 3),
+            "requested": requested,
+            "chosen": model,
+            "reason": reason,
+            "target_ms": target_ms,
+            "inflight": self.inflight,
+            "salient": salient,
+        })
+        per_model = self.counts.setdefault(model, {})
+        per_model[reason] = per_model.get(reason, 0) + 1
+        return model, reason
+
+    @contextmanager
+    def track(self):
+        """统计进行中的解说请求数（负载）"""
+        self.inflight += 1
+        try:
+            yield
+        finally:
+            self.inflight -= 1
+
+    def snapshot(self) -> dict:
+        return {
+            "enabled": COMMENTARY_ROUTER_ENABLED,
+            "inflight": self.inflight,
+            "high_load": self.high_load,
+            "models": {model: guard.snapshot() for model, guard in self.guards.items()},
+            "counts": self.counts,
+            "recent_decisions": list(self.decisions),
+        }
+
+
+tts_guard = UpstreamGuard("TTS")
+commentary_router = ModelRouter(COMMENTARY_MODELS, COMMENTARY_HIGH_LOAD)
+
+# 高光时刻事件：路由时升级模型
+SALIENT_EVENT_TYPES = {"game_over"}
+
+
+def get_request_deadline(http_request: Request) -> tuple:
+    """
+    根据请求的剩余时间预算计算上游调用截止时间，返回 (截止时间, 是否短于默认预算)
+    客户端可通过 X-Request-Budget-Ms 头声明剩余预算（上限 UPSTREAM_MAX_BUDGET_MS）
+    """
+    budget_ms = UPSTREAM_BUDGET_MS
+    header = http_request.headers.get("x-request-budget-ms")
+    if header:
+        try:
+            budget_ms = min(max(0, int(float(header))), UPSTREAM_MAX_BUDGET_MS)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"X-Request-Budget-Ms 无效：{header}")
+    return time.monotonic() + budget_ms / 1000, budget_ms < UPSTREAM_BUDGET_MS
+
+
+def upstream_unavailable_error(e: UpstreamUnavailable) -> HTTPException:
+    """将上游不可用转换为 503（熔断）或 504（超时），而不是笼统的 500"""
+    if e.retry_after is not None:
+        return HTTPException(
+            status_code=503,
+            detail=f"上游服务暂不可用：{e}",
+            headers={"Retry-After": str(max(1, round(e.retry_after)))}
+        )
+    return HTTPException(status_code=504, detail=f"上游服务超时：{e}")
+
+
+# 上游不可用时的兜底解说（按最近一个事件类型选取）
+FALLBACK_COMMENTARY = {
+    "game_start": ["比赛开始！双方选手准备就绪！", "新的一局开打，让我们拭目以待！"],
+    "card_played": ["这张牌出得果断，场上局势要变了！", "好一手操作，看看对面怎么接！"],
+    "damage_dealt": ["一记重击！血量被狠狠压下去了！", "伤害打满，这波压力给到了！"],
+    "heal": ["稳住了！关键时刻回了一口血！", "治疗到位，续航能力拉满！"],
+    "turn_start": ["新回合开始，看看这次有什么妙招！", "轮到出手了，节奏要掌握好！"],
+    "turn_end": ["回合结束，双方都在蓄力！", "这回合打完，局势依然胶着！"],
+    "game_over": ["比赛结束！精彩的对决！", "胜负已分，感谢双方带来的精彩表演！"],
+}
+FALLBACK_COMMENTARY_DEFAULT = ["场上局势胶着，双方都在寻找机会！"]
+
+
+def fallback_commentary(events: list) -> str:
+    """上游不可用时返回预设解说"""
+    event_type = events[-1].get("type", "") if events and isinstance(events[-1], dict) else ""
+    return random.choice(FALLBACK_COMMENTARY.get(event_type, FALLBACK_COMMENTARY_DEFAULT))
+
+
 # TTS 请求模型
 class TTSRequest(BaseModel):
     text: str  # JS 端只上报纯文本，所有 TTS 参数统一在 Python 端配置
 
 
+# TTS 音频格式表
+# 每种格式直接向 CosyVoice 请求对应的编码，服务端不做任何转码
+# - opus: 低码率，适合移动端观众节省带宽
+# - mp3:  兼容性最好（默认）
+# - pcm:  原始 16bit 单声道采样，解码延迟最低
+# - wav:  带 RIFF 头的 PCM，可直接被浏览器播放
+TTS_AUDIO_FORMATS = {
+    "opus": {
+        "upstream": AudioFormat.OGG_OPUS_24KHZ_MONO_32KBPS,
+        "media_type": "audio/ogg; codecs=opus",
+        "extension": "opus",
+    },
+    "mp3": {
+        "upstream": AudioFormat.MP3_24000HZ_MONO_256KBPS,
+        "media_type": "audio/mpeg",
+        "extension": "mp3",
+    },
+    "pcm": {
+        "upstream": AudioFormat.PCM_24000HZ_MONO_16BIT,
+        "media_type": "audio/L16; rate=24000; channels=1",
+        "extension": "pcm",
+    },
+    "wav": {
+        "upstream": AudioFormat.WAV_24000HZ_MONO_16BIT,
+        "media_type": "audio/wav",
+        "extension": "wav",
+    },
+}
+if TTS_DEFAULT_FORMAT not in TTS_AUDIO_FORMATS:
+    print(f"⚠ 未知的 TTS_DEFAULT_FORMAT={TTS_DEFAULT_FORMAT}，回退为 mp3")
+    TTS_DEFAULT_FORMAT = "mp3"
+
+# Accept 头中的媒体类型 -> 格式名
+TTS_ACCEPT_MEDIA_TYPES = {
+    "audio/ogg": "opus",
+    "audio/opus": "opus",
+    "audio/mpeg": "mp3",
+    "audio/mp3": "mp3",
+    "audio/l16": "pcm",
+    "audio/pcm": "pcm",
+    "audio/wav": "wav",
+    "audio/wave": "wav",
+    "audio/x-wav": "wav",
+}
+
+
+def negotiate_audio_format(accept: Optional[str], format_param: Optional[str]) -> tuple:
+    """
+    协商 TTS 输出格式，返回 (格式, 客户端是否明确指定)
+    优先级：查询参数 format > Accept 头（按 q 值排序）> TTS_DEFAULT_FORMAT
+    未指定或只给出通配符（audio/*、*/*）时视为未明确指定
+    """
+    if format_param:
+        fmt = format_param.strip().lower()
+        if fmt not in TTS_AUDIO_FORMATS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"不支持的音频格式：{format_param}（可选：{', '.join(TTS_AUDIO_FORMATS)}）"
+            )
+        return fmt, True
+
+    if not accept:
+        return TTS_DEFAULT_FORMAT, False
+
+    candidates = []
+    for index, part in enumerate(accept.split(",")):
+        params = [p.strip() for p in part.split(";")]
+        media_type = params[0].lower()
+        if not media_type:
+            continue
+        quality = 1.0
+        for param in params[1:]:
+            if param.lower().startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            # q 值相同时保持客户端给出的顺序
+            candidates.append((-quality, index, media_type))
+
+    for _, _, media_type in sorted(candidates):
+        if media_type in TTS_ACCEPT_MEDIA_TYPES:
+            return TTS_ACCEPT_MEDIA_TYPES[media_type], True
+        if media_type in ("audio/*", "*/*"):
+            return TTS_DEFAULT_FORMAT, False
+
+    raise HTTPException(
+        status_code=406,
+        detail=f"无法满足 Accept 头：{accept}（支持：{', '.join(TTS_AUDIO_FORMATS)}）"
+    )
+
+
+# 最近被客户端协商使用的音频格式 -> 最后使用时间，预生成时按这些格式预热 TTS 缓存
+TTS_RECENT_FORMAT_SECONDS = 600
+tts_recent_formats = {}
+
+
+def recent_tts_formats() -> list:
+    """最近 TTS_RECENT_FORMAT_SECONDS 秒内被请求过的格式；没有记录时只返回默认格式"""
+    now = time.monotonic()
+    formats = [f for f, seen in tts_recent_formats.items() if now - seen <= TTS_RECENT_FORMAT_SECONDS]
+    return formats or [TTS_DEFAULT_FORMAT]
+
+
+# TTS 音频缓存（LRU），键为 (模型, 音色, 语速, 格式, 文本)
+# 同一句解说的每种编码只合成一次；并发的相同请求共享同一个进行中的合成任务
+tts_audio_cache: "OrderedDict[tuple, bytes]" = OrderedDict()
+tts_inflight: dict = {}
+tts_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def synthesize_speech(text: str, audio_format: str, timeout: Optional[float] = None) -> bytes:
+    """
+    同步调用 CosyVoice 合成语音（阻塞，需在线程池中执行）
+    所有 TTS 参数（model、voice 等）只在 Python 端维护，前端只负责上传文本内容
+    """
+    if not DASHSCOPE_API_KEY:
+        raise Exception("DashScope API Key 未配置")
+
+    request_synthesizer = SpeechSynthesizer(
+        model=COSYVOICE_MODEL,
+        voice=COSYVOICE_VOICE,
+        format=TTS_AUDIO_FORMATS[audio_format]["upstream"],
+        speech_rate=COSYVOICE_SPEECH_RATE,  # 设置语速（1.0为正常语速）
+    )
+    try:
+        # 使用纯文本（SSML 不支持流式调用）
+        timeout_millis = max(1, int(timeout * 1000)) if timeout is not None else None
+        result = request_synthesizer.call(text=text, timeout_millis=timeout_millis)
+        print(f"[TTS调试] call() 返回值类型: {type(result)}, 格式: {audio_format}")
+
+        if result is None:
+            raise UpstreamError("TTS API 返回 None，未返回任何音频数据")
+
+        if not isinstance(result, (bytes, bytearray)):
+            raise UpstreamError(f"TTS API 返回格式异常：期望 bytes，实际为 {type(result)}")
+
+        return bytes(result)
+    finally:
+        # 显式清理 synthesizer 引用，帮助释放底层资源
+        del request_synthesizer
+
+
+async def get_tts_audio(text: str, audio_format: str, deadline: float, hedge: bool = True) -> bytes:
+    """获取指定格式的 TTS 音频，优先命中缓存；未命中时经 tts_guard 调用上游"""
+    key = (COSYVOICE_MODEL, COSYVOICE_VOICE, COSYVOICE_SPEECH_RATE, audio_format, text)
+
+    cached = tts_audio_cache.get(key)
+    if cached is not None:
+        tts_audio_cache.move_to_end(key)
+        tts_cache_stats["hits"] += 1
+        return cached
+
+    pending = tts_inflight.get(key)
+    if pending is not None:
+        tts_cache_stats["hits"] += 1
+    else:
+        tts_cache_stats["misses"] += 1
+        # 合成任务由所有等待者共享，至少给它默认时间预算，避免被发起者较短的预算提前放弃
+        synthesis_deadline = max(deadline, time.monotonic() + UPSTREAM_BUDGET_MS / 1000)
+        pending = asyncio.ensure_future(
+            tts_guard.call(
+                lambda timeout: synthesize_speech(text, audio_format, timeout), synthesis_deadline, hedge=hedge
+            )
+        )
+        tts_inflight[key] = pending
+        pending.add_done_callback(lambda task: store_tts_audio(key, task))
+
+    # 共享的合成任务可能属于预算更长的请求，这里按本请求的截止时间等待
+    try:
+        audio_bytes = await asyncio.wait_for(
+            asyncio.shield(pending), timeout=max(0.0, deadline - time.monotonic())
+        )
+    except asyncio.TimeoutError:
+        raise UpstreamUnavailable("TTS 超出时间预算")
+    return audio_bytes
+
+
+def store_tts_audio(key: tuple, task: asyncio.Future):
+    """
+    合成任务完成回调：写入缓存并移出进行中列表
+    即使所有等待者都已因各自的截止时间放弃，合成结果仍会写入缓存，不会重复合成
+    """
+    tts_inflight.pop(key, None)
+    if task.cancelled() or task.exception() is not None or TTS_CACHE_SIZE <= 0:
+        return
+    tts_audio_cache[key] = task.result()
+    while len(tts_audio_cache) > TTS_CACHE_SIZE:
+        tts_audio_cache.popitem(last=False)
+        tts_cache_stats["evictions"] += 1
+
+
+def find_cached_tts_variant(text: str) -> Optional[tuple]:
+    """在缓存中查找同一句文本的任意格式音频，供上游不可用时兜底"""
+    for (model, voice, rate, audio_format, cached_text), audio_bytes in tts_audio_cache.items():
+        if (model, voice, rate, cached_text) == (COSYVOICE_MODEL, COSYVOICE_VOICE, COSYVOICE_SPEECH_RATE, text):
+            return audio_format, audio_bytes
+    return None
+
+
 # 解说员文本生成请求模型
 class CommentaryRequest(BaseModel):
     events: list  # 最近的事件列表
     game_state: Optional[dict] = None  # 游戏状态
     model: Optional[str] = "qwen-plus"
+    latency_target_ms: Optional[int] = None  # 延迟目标，模型路由据此选择模型（默认 COMMENTARY_LATENCY_TARGET_MS）
     max_tokens: Optional[int] = 50
     temperature: Optional[float] = 0.9
 
 
+# ========== 推测式预生成（根据当前手牌预先生成解说和语音） ==========
+# 玩家思考期间，在后台为最可能打出的 top-k 张可用手牌生成解说并合成语音；
+# 真实的 card_played 事件到达时直接返回预生成的解说，语音已在 TTS 缓存中
+
+PREFETCH_MAX_ENTRIES = 64
+
+# (出牌方, 卡牌名) -> {"commentary", "model", "turn_number", "created_at", "tokens", "tts_chars"}
+# turn_number 为预生成时的回合数，只有同一回合内打出该卡牌才算命中
+prefetch_store: "OrderedDict[tuple, dict]" = OrderedDict()
+prefetch_pending: set = set()
+prefetch_tasks: set = set()
+prefetch_spend_window = deque()  # 最近一分钟内预生成的时间戳
+prefetch_slot = asyncio.Semaphore(1)  # 预生成串行执行，避免与前台请求争抢上游
+foreground_inflight = {"count": 0}
+prefetch_stats = {
+    "scheduled": 0, "generated": 0, "hits": 0, "misses": 0, "wasted": 0, "failed": 0,
+    "skipped_budget": 0, "skipped_busy": 0,
+    "tokens": 0, "tts_chars": 0, "wasted_tokens": 0, "wasted_tts_chars": 0,
+}
+
+
+@contextmanager
+def foreground_call():
+    """标记一次前台上游调用，期间后台预生成让路"""
+    foreground_inflight["count"] += 1
+    try:
+        yield
+    finally:
+        foreground_inflight["count"] -= 1
+
+
+def prefetch_key(player, card_name) -> tuple:
+    return ("player" if player == "player" else "opponent", card_name)
+
+
+def get_hand(game_state: dict, side: str) -> list:
+    """
+    读取一方手牌：前端序列化的 GameState 中手牌位于 player.hand / opponent.hand，
+    兼容顶层的 playerHand / opponentHand
+    """
+    hand = (game_state.get(side) or {}).get('hand')
+    if not isinstance(hand, list):
+        hand = game_state.get(f'{side}Hand')
+    return hand if isinstance(hand, list) else []
+
+
+def rank_prefetch_candidates(game_state: dict) -> list:
+    """
+    从当前出牌方的手牌中挑出最可能打出的 top-k 张卡牌
+    只考虑能量足够的卡牌，按 伤害+治疗+抽牌 的收益排序，收益相同时优先高消耗
+    """
+    summary = get_game_state_summary(game_state)
+    side = 'player' if summary['turn'] == 'player' else 'opponent'
+    hand, mana = get_hand(game_state, side), summary[f'{side}Mana']
+
+    playable = {}
+    for card in hand:
+        if not isinstance(card, dict) or not card.get('name'):
+            continue
+        if (card.get('cost') or 0) > mana:
+            continue
+        playable.setdefault(card['name'], card)
+
+    def score(card):
+        value = (card.get('power') or 0) + (card.get('heal') or 0) + 5 * (card.get('draw') or 0)
+        return (value, card.get('cost') or 0)
+
+    return sorted(playable.values(), key=score, reverse=True)[:PREFETCH_TOP_K]
+
+
+def discard_prefetch_entry(key: tuple):
+    """丢弃一条未被使用的预生成结果，计入浪费的上游花费"""
+    entry = prefetch_store.pop(key)
+    prefetch_stats["wasted"] += 1
+    prefetch_stats["wasted_tokens"] += entry["tokens"]
+    prefetch_stats["wasted_tts_chars"] += entry["tts_chars"]
+
+
+def expire_prefetch_entries():
+    now = time.monotonic()
+    for key in [k for k, v in prefetch_store.items() if now - v["created_at"] > PREFETCH_TTL_SECONDS]:
+        discard_prefetch_entry(key)
+    while len(prefetch_store) > PREFETCH_MAX_ENTRIES:
+        discard_prefetch_entry(next(iter(prefetch_store)))
+
+
+def prefetch_budget_available() -> bool:
+    now = time.monotonic()
+    while prefetch_spend_window and now - prefetch_spend_window[0] > 60:
+        prefetch_spend_window.popleft()
+    return len(prefetch_spend_window) < PREFETCH_MAX_PER_MINUTE
+
+
+def prefetch_should_yield(model: str) -> bool:
+    """前台有上游调用进行中，或上游已熔断时，后台预生成让路"""
+    return (foreground_inflight["count"] > 0
+            or commentary_router.guard(model).breaker.state != "closed"
+            or tts_guard.breaker.state != "closed")
+
+
+def schedule_prefetch(events: list, game_state: Optional[dict], model: Optional[str],
+                      max_tokens: Optional[int], temperature: Optional[float]) -> int:
+    """为当前出牌方的候选卡牌安排后台预生成，返回新安排的任务数"""
+    if not PREFETCH_ENABLED or not openai_client or not game_state:
+        return 0
+
+    expire_prefetch_entries()
+    turn_number = game_state.get('turnNumber', 1)
+    player = game_state.get('turn', 'player')
+    scheduled = 0
+    for card in rank_prefetch_candidates(game_state):
+        key = prefetch_key(player, card['name'])
+        if key in prefetch_pending:
+            continue
+        if key in prefetch_store:
+            if prefetch_store[key]["turn_number"] == turn_number:
+                continue
+            # 上一回合预生成但未打出的卡牌，上下文已过时
+            discard_prefetch_entry(key)
+        prefetch_pending.add(key)
+        task = asyncio.create_task(
+            prefetch_commentary(key, turn_number, list(events or []), game_state, card,
+                                model, max_tokens, temperature)
+        )
+        prefetch_tasks.add(task)
+        task.add_done_callback(prefetch_tasks.discard)
+        prefetch_stats["scheduled"] += 1
+        scheduled += 1
+    return scheduled
+
+
+async def prefetch_commentary(key: tuple, turn_number, events: list, game_state: dict, card: dict,
+                              model: Optional[str], max_tokens: Optional[int], temperature: Optional[float]):
+    """后台任务：为一张候选卡牌生成解说并合成语音（低优先级，不对冲）"""
+    model = commentary_router.resolve(model)
+    try:
+        async with prefetch_slot:
+            if prefetch_should_yield(model):
+                prefetch_stats["skipped_busy"] += 1
+                return
+            if not prefetch_budget_available():
+                prefetch_stats["skipped_budget"] += 1
+                return
+            prefetch_spend_window.append(time.monotonic())
+
+            # 假设该卡牌即将被打出，按真实请求的方式构建提示词
+            speculative_events = events[-5:] + [{
+                "type": "card_played",
+                "data": {"player": key[0], "card": card},
+            }]
+            messages = build_commentary_messages(speculative_events, game_state)
+            deadline = time.monotonic() + UPSTREAM_BUDGET_MS / 1000
+            completion = await commentary_router.guard(model).call(
+                lambda timeout: create_commentary_completion(messages, model, max_tokens, temperature, timeout),
+                deadline,
+                hedge=False,
+            )
+            commentary = str(completion.choices[0].message.content or "").strip()
+            if not commentary:
+                raise ValueError("生成的解说文本为空")
+            usage = getattr(completion, "usage", None)
+            entry = {
+                "commentary": commentary,
+                "model": model,
+                "turn_number": turn_number,
+                "created_at": time.monotonic(),
+                "tokens": getattr(usage, "total_tokens", 0) or 0,
+                "tts_chars": 0,
+            }
+            prefetch_stats["generated"] += 1
+            prefetch_stats["tokens"] += entry["tokens"]
+
+            # 按客户端最近协商的各个格式合成语音并写入 TTS 缓存，真实请求到达时 /api/tts 直接命中
+            for audio_format in recent_tts_formats():
+                if not synthesizer or prefetch_should_yield(model):
+                    break
+                await get_tts_audio(commentary, audio_format, deadline, hedge=False)
+                entry["tts_chars"] += len(commentary)
+                prefetch_stats["tts_chars"] += len(commentary)
+
+            prefetch_store[key] = entry
+            expire_prefetch_entries()
+            print(f"[预生成] {key[0]} {key[1]} 第{turn_number}回合: {commentary}")
+    except Exception as e:
+        prefetch_stats["failed"] += 1
+        print(f"[预生成] 失败 {key}: {e}")
+    finally:
+        prefetch_pending.discard(key)
+
+
+def take_prefetched_commentary(events: list) -> Optional[dict]:
+    """
+    在本批事件（自上次请求以来）的出牌事件中查找已预生成的卡牌，取出并返回最新一次出牌对应的结果
+    本批包含 card_played 时才计入命中/未命中；
+    出牌事件带 turnNumber 时需与预生成时的回合一致，否则视为同一卡牌在本回合的预生成
+    """
+    if not PREFETCH_ENABLED or not events:
+        return None
+    card_events = [e for e in events if isinstance(e, dict) and e.get('type') == 'card_played']
+    if not card_events:
+        return None
+
+    expire_prefetch_entries()
+    for card_event in reversed(card_events):
+        data = card_event.get('data') or {}
+        key = prefetch_key(data.get('player'), (data.get('card') or {}).get('name'))
+        entry = prefetch_store.get(key)
+        if entry is None:
+            continue
+        event_turn = data.get('turnNumber')
+        if event_turn is not None and event_turn != entry["turn_number"]:
+            discard_prefetch_entry(key)
+            continue
+        del prefetch_store[key]
+        prefetch_stats["hits"] += 1
+        return entry
+    prefetch_stats["misses"] += 1
+    return None
+
+
+def prefetch_snapshot() -> dict:
+    lookups = prefetch_stats["hits"] + prefetch_stats["misses"]
+    generated = prefetch_stats["generated"]
+    return {
+        "enabled": PREFETCH_ENABLED,
+        "top_k": PREFETCH_TOP_K,
+        "entries": len(prefetch_store),
+        "pending": len(prefetch_pending),
+        "hit_rate": round(prefetch_stats["hits"] / lookups, 3) if lookups else None,
+        "waste_rate": round(prefetch_stats["wasted"] / generated, 3) if generated else None,
+        **prefetch_stats,
+    }
+
+
+def create_commentary_completion(messages, model, max_tokens, temperature, timeout):
+    """同步调用 Qwen 生成解说（阻塞，需经 UpstreamGuard 在线程池中执行）"""
+    return openai_client.chat.completions.create(
+        model=model or "qwen-plus",
+        messages=messages,
+        max_tokens=max_tokens or 50,
+        temperature=temperature or 0.9,
+        timeout=timeout,
+    )
+
+
+# ========== 按需采样分析器（火焰图 / 事件循环延迟） ==========
+
+class SamplingProfiler:
+    """
+    低开销的采样分析器，只在管理端点指定的时间窗口内运行：
+    - 后台线程按固定间隔通过 sys._current_frames() 采样所有线程（事件循环线程和线程池）的调用栈，
+      聚合为 collapsed-stack 格式（可直接用 flamegraph.pl / speedscope 生成火焰图）
+    - 事件循环上的心跳任务测量回调计划时间与实际执行时间之差（事件循环延迟）；
+      心跳停滞超过阈值时，事件循环线程的调用栈单独计入 blocking_stacks，
+      同步阻塞调用（如 SpeechSynthesizer.call）会直接出现在这里
+    事件循环线程是否空闲由心跳判断（与 asyncio / uvloop / Windows proactor 的实现无关）：
+    心跳按时到达说明事件循环没有在执行耗时回调，此时的采样默认不计入
+    """
+
+    # 工作线程空闲等待的栈顶帧（文件名, 函数名），默认不计入采样
+    IDLE_FRAMES = {
+        ("threading.py", "wait"),
+        ("queue.py", "get"),
+        ("thread.py", "_worker"),
+    }
+    HEARTBEAT_SECONDS = 0.01
+    # 心跳超过两个周期未到达，视为事件循环正忙
+    BUSY_SECONDS = HEARTBEAT_SECONDS * 2
+
+    def __init__(self, interval: float, lag_threshold: float, include_idle: bool = False):
+        self.interval = interval
+        self.lag_threshold = lag_threshold
+        self.include_idle = include_idle
+        self.stacks = Counter()
+        self.blocking_stacks = Counter()
+        self.thread_samples = Counter()
+        self.samples = 0
+        self.lag = LatencyTracker(window=int(PROFILER_MAX_SECONDS / self.HEARTBEAT_SECONDS))
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = None
+        self.started_at = 0.0
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """在事件循环线程中调用，记录事件循环线程并启动采样线程"""
+        self.loop_thread_id = threading.get_ident()
+        self.started_at = self.heartbeat = time.monotonic()
+        self._thread = threading.Thread(target=self._sample_loop, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.duration = time.monotonic() - self.started_at
+
+    @staticmethod
+    def frame_label(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+    def collapse(self, frame) -> str:
+        labels = []
+        while frame is not None:
+            labels.append(self.frame_label(frame))
+            frame = frame.f_back
+        return ";".join(reversed(labels))
+
+    def is_idle(self, frame) -> bool:
+        return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in self.IDLE_FRAMES
+
+    def _sample_loop(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            heartbeat_age = time.monotonic() - self.heartbeat
+            loop_busy = heartbeat_age > self.BUSY_SECONDS
+            loop_blocked = heartbeat_age > self.lag_threshold
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if thread_id == self.loop_thread_id:
+                    if not self.include_idle and not loop_busy:
+                        continue
+                    name = "event-loop"
+                else:
+                    if not self.include_idle and self.is_idle(frame):
+                        continue
+                    name = names.get(thread_id, f"thread-{thread_id}")
+                key = f"{name};{self.collapse(frame)}"
+                self.stacks[key] += 1
+                self.thread_samples[name] += 1
+                if thread_id == self.loop_thread_id and loop_blocked:
+                    self.blocking_stacks[key] += 1
+            self.samples += 1
+
+    async def monitor_event_loop_lag(self):
+        """事件循环心跳：记录每次回调的实际执行时间比计划时间晚了多少"""
+        loop = asyncio.get_running_loop()
+        while not self._stop.is_set():
+            expected = loop.time() + self.HEARTBEAT_SECONDS
+            await asyncio.sleep(self.HEARTBEAT_SECONDS)
+            lag = max(0.0, loop.time() - expected)
+            self.heartbeat = time.monotonic()
+            self.lag.record(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.lag_threshold:
+                self.stalls += 1
+
+    @staticmethod
+    def format_collapsed(stacks: Counter) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+
+    def report(self) -> dict:
+        def ms(value):
+            return round(value * 1000, 2) if value is not None else None
+
+        return {
+            "duration_s": round(self.duration, 3),
+            "interval_ms": ms(self.interval),
+            "samples": self.samples,
+            "threads": dict(self.thread_samples.most_common()),
+            "event_loop_lag_ms": {
+                "p50": ms(self.lag.percentile(50)),
+                "p95": ms(self.lag.percentile(95)),
+                "p99": ms(self.lag.percentile(99)),
+                "max": ms(self.max_lag),
+                "ticks": len(self.lag.samples),
+                "stalls": self.stalls,
+                "stall_threshold_ms": ms(self.lag_threshold),
+            },
+            "top_stacks": [{"stack": k, "count": v} for k, v in self.stacks.most_common(20)],
+            "blocking_stacks": [{"stack": k, "count": v} for k, v in self.blocking_stacks.most_common(20)],
+            "collapsed": self.format_collapsed(self.stacks),
+        }
+
+
+active_profiler = {"profiler": None}
+
+
+def require_admin(http_request: Request):
+    """
+    管理端点鉴权：必须配置 ADMIN_TOKEN 并通过 X-Admin-Token 头传递
+    未配置时一律拒绝（反向代理后所有请求都来自本机，不能按来源地址放行）
+    """
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="管理端点未启用：请配置 ADMIN_TOKEN")
+    token = http_request.headers.get("x-admin-token", "")
+    if not secrets.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="管理令牌无效")
+
+
 # 健康检查
 @app.get("/health")
 async def health_check():
@@ -197,6 +1243,13 @@ async def health_check():
         "status": "ok",
         "dashscope_configured": bool(DASHSCOPE_API_KEY),
         "tts_initialized": synthesizer is not None,
+        "tts_default_format": TTS_DEFAULT_FORMAT,
+        "tts_cache": {**tts_cache_stats, "entries": len(tts_audio_cache), "capacity": TTS_CACHE_SIZE},
+        "upstream": {
+            "tts": tts_guard.snapshot(),
+            "commentary": commentary_router.snapshot()["models"],
+        },
+        "prefetch": prefetch_snapshot(),
         "static_files_dir": str(DIST_DIR),
         "static_files_exists": DIST_DIR.exists()
     }
@@ -233,12 +1286,15 @@ async def memori_debug():
     return debug_info
 
 
-# TTS 服务端点（流式处理）
+# TTS 服务端点
 @app.post("/api/tts")
-async def text_to_speech(request: TTSRequest):
+async def text_to_speech(request: TTSRequest, http_request: Request, format: Optional[str] = None):
     """
-    文本转语音服务（流式处理）
-    使用 CosyVoice Python SDK 将文本转换为语音，流式返回音频数据
+    文本转语音服务
+    使用 CosyVoice Python SDK 将文本转换为语音
+    输出格式由查询参数 format（opus/mp3/pcm/wav）或 Accept 头协商，
+    按格式直接向上游请求对应编码，并按 文本+格式 缓存
+    上游调用受 tts_guard 保护（对冲请求、熔断、时间预算）
     """
     if not synthesizer:
         raise HTTPException(
@@ -258,95 +1314,119 @@ async def text_to_speech(request: TTSRequest):
             detail=f"文本长度超过限制：{text_length}字（最大{MAX_TEXT_LENGTH}字）。请缩短文本长度。"
         )
     
-    # 用于存储检测到的音频格式（在generator外部定义，以便在StreamingResponse中使用）
-    detected_audio_format = {"format": "audio/mpeg"}  # 使用字典以便在内部函数中修改
+    audio_format, format_explicit = negotiate_audio_format(http_request.headers.get("accept"), format)
+    tts_recent_formats[audio_format] = time.monotonic()
+    deadline, _ = get_request_deadline(http_request)
+    tts_text = request.text.strip()
+    fallback_headers = {}
     
-    async def generate_audio_stream():
-        """
-        生成 TTS 音频的异步生成器（单层 try/except，逻辑尽量简单清晰）
-        """
-        request_synthesizer = None
-        
-        try:
-            # 基础检查
-            if not DASHSCOPE_API_KEY:
-                raise Exception("DashScope API Key 未配置")
-            
-            # 为当前请求创建新的 synthesizer 实例
-            # 约定：所有 TTS 参数（model、voice 等）只在 Python 端维护，
-            #       前端只负责上传文本内容。
-            request_synthesizer = SpeechSynthesizer(
-                model=COSYVOICE_MODEL,
-                voice=COSYVOICE_VOICE,
-                speech_rate=COSYVOICE_SPEECH_RATE,  # 设置语速（1.0为正常语速）
-            )
-            
-            # 使用纯文本（SSML 不支持流式调用）
-            tts_text = request.text.strip()
-            
-            # 调用 TTS 接口（当前模型返回 bytes 音频数据）
-            result = request_synthesizer.call(text=tts_text)
-            print(f"[TTS调试] call() 返回值类型: {type(result)}")
-
-            if result is None:
-                raise Exception("TTS API 返回 None，未返回任何音频数据")
-
-            if not isinstance(result, (bytes, bytearray)):
-                raise Exception(f"TTS API 返回格式异常：期望 bytes，实际为 {type(result)}")
-
-            # 直接将字节数据分块写入响应
-            audio_bytes = bytes(result)
-            chunk_size = 8192
-            for i in range(0, len(audio_bytes), chunk_size):
-                chunk = audio_bytes[i:i + chunk_size]
-                if chunk:
-                    yield chunk
-            return
-                    
-        except httpx.HTTPError as http_error:
-            import traceback
-
-            error_msg = f"HTTP请求失败: {str(http_error)}"
-            print(f"TTS 转换错误: {error_msg}")
-            print(traceback.format_exc())
-            raise Exception(error_msg)
-        except Exception as e:
-            import traceback
+    try:
+        with foreground_call():
+            audio_bytes = await get_tts_audio(tts_text, audio_format, deadline)
+    except UpstreamUnavailable as e:
+        # 上游熔断或超时：客户端未明确指定格式时，如果同一句话有其它格式的缓存，降级返回该格式
+        variant = None if format_explicit else find_cached_tts_variant(tts_text)
+        if variant is None:
+            raise upstream_unavailable_error(e)
+        print(f"[TTS] 上游不可用（{e}），使用缓存的 {variant[0]} 音频兜底")
+        audio_format, audio_bytes = variant
+        fallback_headers["X-TTS-Fallback"] = "cache"
+    except Exception as e:
+        import traceback
 
-            error_msg = str(e) if e else "未知错误"
-            print(f"TTS 转换错误: {error_msg}")
-            print(traceback.format_exc())
-            # 继续抛出，让上层 StreamingResponse 处理
-            raise
-        finally:
-            # 显式清理 synthesizer 引用，帮助释放底层资源
-            if request_synthesizer is not None:
-                del request_synthesizer
+        error_msg = str(e) if e else "未知错误"
+        print(f"TTS 转换错误: {error_msg}")
+        print(traceback.format_exc())
+        raise HTTPException(status_code=502, detail=f"TTS 转换失败: {error_msg}")
     
-    # 返回流式音频响应
-    # 注意：StreamingResponse会在实际读取generator时才执行，所以这里的try-except
-    # 只能捕获创建StreamingResponse对象时的错误，不能捕获generator内部的错误
-    # generator内部的错误会在客户端读取流时发生，FastAPI会自动处理
-    # 注意：由于generator是异步执行的，audio_format可能在generator执行后才确定
-    # 所以这里使用默认值，实际格式会在响应头中动态设置（如果可能）
-    return StreamingResponse(
-        generate_audio_stream(),
-        media_type=detected_audio_format["format"],  # 使用检测到的格式，默认为audio/mpeg
+    format_info = TTS_AUDIO_FORMATS[audio_format]
+    # 音频已完整生成，直接返回并给出准确的 Content-Length（Response 会自动设置）
+    return Response(
+        content=audio_bytes,
+        media_type=format_info["media_type"],
         headers={
-            "Content-Disposition": "inline; filename=tts_audio.mp3",
+            "Content-Disposition": f"inline; filename=tts_audio.{format_info['extension']}",
             "Cache-Control": "no-cache",
-            "Transfer-Encoding": "chunked",
-            "X-Accel-Buffering": "no"  # 禁用Nginx缓冲，确保真正的流式传输
+            "Vary": "Accept",
+            "X-Audio-Format": audio_format,
+            **fallback_headers,
         }
     )
 
 
+# 推测式预生成端点：客户端可在玩家思考时主动触发
+@app.post("/api/commentary/prefetch")
+async def prefetch_commentary_endpoint(request: CommentaryRequest):
+    """为当前出牌方最可能打出的卡牌安排后台预生成"""
+    if not request.game_state:
+        raise HTTPException(status_code=400, detail="预生成需要提供 game_state")
+    scheduled = schedule_prefetch(request.events, request.game_state, request.model,
+                                  request.max_tokens, request.temperature)
+    return {"status": "scheduled", "scheduled": scheduled}
+
+
+# 推测式预生成统计：命中率与浪费的上游花费
+@app.get("/api/commentary/prefetch")
+async def prefetch_stats_endpoint():
+    """推测式预生成统计"""
+    return prefetch_snapshot()
+
+
+# 模型路由状态：各模型延迟/错误率与最近的路由决策
+@app.get("/api/commentary/router")
+async def commentary_router_endpoint():
+    """解说模型路由状态"""
+    return commentary_router.snapshot()
+
+
+# 采样分析端点：在指定时间窗口内采样调用栈并测量事件循环延迟
+@app.post("/api/admin/profile")
+async def profile_endpoint(http_request: Request, seconds: float = 10, interval_ms: float = 10,
+                           format: str = "json", include_idle: bool = False):
+    """
+    按需采样分析
+    format=json 返回汇总（含 collapsed 字段），format=collapsed 直接返回 collapsed-stack 文本
+    """
+    require_admin(http_request)
+    if not 0 < seconds <= PROFILER_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds 需在 (0, {PROFILER_MAX_SECONDS}] 之间")
+    if not 1 <= interval_ms <= 1000:
+        raise HTTPException(status_code=400, detail="interval_ms 需在 [1, 1000] 之间")
+    if format not in ("json", "collapsed"):
+        raise HTTPException(status_code=400, detail="format 仅支持 json 或 collapsed")
+    if active_profiler["profiler"] is not None:
+        raise HTTPException(status_code=409, detail="已有采样正在进行")
+
+    profiler = SamplingProfiler(interval_ms / 1000, PROFILER_LAG_THRESHOLD_MS / 1000, include_idle)
+    active_profiler["profiler"] = profiler
+    print(f"[采样分析] 开始采样 {seconds}s，间隔 {interval_ms}ms")
+    monitor = None
+    try:
+        profiler.start()
+        monitor = asyncio.create_task(profiler.monitor_event_loop_lag())
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stop()
+        active_profiler["profiler"] = None
+        if monitor is not None:
+            await monitor
+
+    report = profiler.report()
+    print(f"[采样分析] 完成：{report['samples']} 次采样，"
+          f"事件循环最大延迟 {report['event_loop_lag_ms']['max']}ms，卡顿 {profiler.stalls} 次")
+    if format == "collapsed":
+        return Response(content=report["collapsed"], media_type="text/plain; charset=utf-8")
+    return report
+
+
 # 解说员文本生成端点
 @app.post("/api/commentary")
-async def generate_commentary(request: CommentaryRequest):
+async def generate_commentary(request: CommentaryRequest, http_request: Request):
     """
     生成游戏解说文本
     使用 Qwen (DashScope) API 生成游戏解说
+    模型由 commentary_router 按延迟目标、负载和事件重要程度选择；
+    上游调用受该模型的 UpstreamGuard 保护，熔断、超时或上游报错时返回预设解说（status=fallback）
     """
     if not DASHSCOPE_API_KEY:
         raise HTTPException(
@@ -358,103 +1438,23 @@ async def generate_commentary(request: CommentaryRequest):
         raise HTTPException(status_code=400, detail="事件列表不能为空")
     
     response = None  # 提前声明，避免在异常场景下出现 UnboundLocalError
+    deadline, caller_limited = get_request_deadline(http_request)
 
-    try:
-        # 构建系统提示词
-        system_prompt = """你是电竞赛事解说员，解说Git卡牌对战。
-
-【游戏规则】生命100，能量每回合+1(最多10)，手牌最多7张。卡牌：攻击型(Add/Commit/Push/Merge/Clone)、治疗型(Pull/Revert)、特殊型(Rebase/Reset/Branch/Stash/Cherry Pick)。
-
-【输出要求】
-- 输出15-30字短句
-- 用中文，口语化，有情绪
+    # 命中推测式预生成：直接返回预先生成的解说（语音已在 TTS 缓存中）
+    prefetched = take_prefetched_commentary(request.events)
+    if prefetched:
+        schedule_prefetch(request.events, request.game_state, request.model,
+                          request.max_tokens, request.temperature)
+        return {
+            "commentary": prefetched["commentary"],
+            "status": "success",
+            "model": prefetched["model"],
+            "prefetched": True
+        }
 
-你可以自由选择任何话题和角度进行解说，不受限制。"""
-        
-        # 构建用户提示词（完整上下文）
-        # 使用所有事件，不限制数量
-        user_prompt = '【事件】'
-        for event in request.events:
-            event_text = event_to_text(event)
-            if event_text:
-                user_prompt += f" {event_text};"
-        
-        if request.game_state:
-            summary = get_game_state_summary(request.game_state)
-            user_prompt += f"\n【战况】玩家{summary['playerHealth']}HP 对手{summary['opponentHealth']}HP 第{summary['turnNumber']}回合"
-            
-            # 关键状态
-            critical = []
-            if summary['playerHealth'] <= 30:
-                critical.append('玩家血量告急')
-            if summary['opponentHealth'] <= 30:
-                critical.append('对手血量告急')
-            if summary.get('playerBuffs'):
-                buff_names = [b.get('name', '') for b in summary['playerBuffs']]
-                if buff_names:
-                    critical.append(f"玩家有buff:{','.join(buff_names)}")
-            if summary.get('opponentBuffs'):
-                buff_names = [b.get('name', '') for b in summary['opponentBuffs']]
-                if buff_names:
-                    critical.append(f"对手有buff:{','.join(buff_names)}")
-            if critical:
-                user_prompt += f" {' '.join(critical)}"
-            
-            # 手牌信息（完整信息，包括卡牌类型、消耗、效果等）
-            player_hand = summary.get('playerHand', [])
-            opponent_hand = summary.get('opponentHand', [])
-            
-            if player_hand:
-                hand_cards = []
-                for c in player_hand:
-                    card_info = f"{c.get('icon', '')}{c.get('name', '')}"
-                    card_type = c.get('type', '')
-                    cost = c.get('cost', 0)
-                    power = c.get('power', 0)
-                    heal = c.get('heal', 0)
-                    draw = c.get('draw', 0)
-                    effects = []
-                    if card_type:
-                        effects.append(f"类型:{card_type}")
-                    if cost > 0:
-                        effects.append(f"消耗:{cost}")
-                    if power > 0:
-                        effects.append(f"伤害{power}")
-                    if heal > 0:
-                        effects.append(f"治疗{heal}")
-                    if draw > 0:
-                        effects.append(f"抽{draw}张")
-                    if effects:
-                        card_info += f"({','.join(effects)})"
-                    hand_cards.append(card_info)
-                user_prompt += f"\n【玩家手牌】{','.join(hand_cards)}"
-            
-            if opponent_hand:
-                hand_cards = []
-                for c in opponent_hand:
-                    card_info = f"{c.get('icon', '')}{c.get('name', '')}"
-                    card_type = c.get('type', '')
-                    cost = c.get('cost', 0)
-                    power = c.get('power', 0)
-                    heal = c.get('heal', 0)
-                    draw = c.get('draw', 0)
-                    effects = []
-                    if card_type:
-                        effects.append(f"类型:{card_type}")
-                    if cost > 0:
-                        effects.append(f"消耗:{cost}")
-                    if power > 0:
-                        effects.append(f"伤害{power}")
-                    if heal > 0:
-                        effects.append(f"治疗{heal}")
-                    if draw > 0:
-                        effects.append(f"抽{draw}张")
-                    if effects:
-                        card_info += f"({','.join(effects)})"
-                    hand_cards.append(card_info)
-                user_prompt += f"\n【对手手牌】{','.join(hand_cards)}"
-        
-        user_prompt += '\n【输出】15-30字短句。'
+    try:
+        # 构建提示词（完整上下文）
+        messages = build_commentary_messages(request.events, request.game_state)
         
         # 确保 API Key 已设置
         if not DASHSCOPE_API_KEY:
@@ -463,18 +1463,6 @@ async def generate_commentary(request: CommentaryRequest):
                 detail="文本生成服务不可用: 未配置 DASHSCOPE_API_KEY"
             )
         
-        # 构建消息列表
-        messages = [
-            {
-                "role": "system",
-                "content": system_prompt
-            },
-            {
-                "role": "user",
-                "content": user_prompt
-            }
-        ]
-        
         # 使用 OpenAI 兼容接口调用 DashScope（Memori 会自动拦截 OpenAI 客户端调用）
         if not openai_client:
             raise HTTPException(
@@ -503,20 +1491,35 @@ async def generate_commentary(request: CommentaryRequest):
             
             # 记录调用前的消息
             print(f"[记忆系统] 调用前消息数量: {len(messages)}")
-            print(f"[记忆系统] 系统提示词长度: {len(system_prompt)} 字符")
-            print(f"[记忆系统] 用户提示词长度: {len(user_prompt)} 字符")
+            print(f"[记忆系统] 系统提示词长度: {len(messages[0]['content'])} 字符")
+            print(f"[记忆系统] 用户提示词长度: {len(messages[1]['content'])} 字符")
             print(f"[记忆系统] 事件数量: {len(request.events)}")
         else:
             print(f"[记忆系统调试] 记忆系统未启用")
         
+        # 按延迟目标、当前负载和事件重要程度选择模型
+        salient = any(
+            isinstance(e, dict) and e.get('type') in SALIENT_EVENT_TYPES for e in request.events
+        )
+        model, route_reason = commentary_router.route(
+            request.model,
+            request.latency_target_ms or COMMENTARY_LATENCY_TARGET_MS,
+            deadline,
+            salient,
+        )
+        print(f"[模型路由] {request.model} -> {model}（{route_reason}）")
+        
         # 使用 OpenAI 客户端调用（Memori 会自动拦截并注入记忆）
+        # 每次调用的超时取自本请求剩余的时间预算
         try:
-            completion = openai_client.chat.completions.create(
-                model=request.model or "qwen-plus",
-                messages=messages,
-                max_tokens=request.max_tokens or 50,
-                temperature=request.temperature or 0.9
-            )
+            with foreground_call(), commentary_router.track():
+                completion = await commentary_router.guard(model).call(
+                    lambda timeout: create_commentary_completion(
+                        messages, model, request.max_tokens, request.temperature, timeout
+                    ),
+                    deadline,
+                    caller_limited=caller_limited,
+                )
             
             # 记录调用后的信息
             if MEMORI_ENABLED and memori:
@@ -534,7 +1537,19 @@ async def generate_commentary(request: CommentaryRequest):
         except Exception as e:
             if MEMORI_ENABLED and memori:
                 print(f"[记忆系统] API调用失败: {e}")
-            raise
+            if isinstance(e, APIStatusError) and e.status_code < 500:
+                # 请求参数等客户端错误：如实返回，而不是用预设解说掩盖
+                raise HTTPException(status_code=400 if e.status_code in (400, 422) else 502,
+                                    detail=f"文本生成失败: {e}")
+            if not is_upstream_failure(e):
+                raise
+            # 上游熔断、超时、连接错误或 5xx：返回预设解说，避免前端解说中断
+            print(f"[解说生成] 上游不可用，使用预设解说兜底: {e}")
+            return {
+                "commentary": fallback_commentary(request.events),
+                "status": "fallback",
+                "model": None
+            }
         
         # 从响应中提取文本
         if hasattr(completion, 'choices') and len(completion.choices) > 0:
@@ -568,11 +1583,18 @@ async def generate_commentary(request: CommentaryRequest):
             print(f"[记忆系统调试] 解说生成完成")
             print(f"{'='*60}\n")
         
+        # 玩家思考下一步期间，为其可能打出的卡牌预生成解说和语音
+        schedule_prefetch(request.events, request.game_state, request.model,
+                          request.max_tokens, request.temperature)
+        
         return {
             "commentary": commentary,  # 纯文本，用于UI显示和TTS
-            "status": "success"
+            "status": "success",
+            "model": model
         }
             
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         print(f"文本生成错误: {e}")
@@ -582,6 +1604,117 @@ async def generate_commentary(request: CommentaryRequest):
         raise HTTPException(status_code=500, detail=f"文本生成失败: {str(e)}")
 
 
+# 辅助函数：构建解说提示词
+def build_commentary_messages(events, game_state):
+    """根据事件列表和游戏状态构建解说生成的消息列表"""
+    # 构建系统提示词
+    system_prompt = """你是电竞赛事解说员，解说Git卡牌对战。
+
+【游戏规则】生命100，能量每回合+1(最多10)，手牌最多7张。卡牌：攻击型(Add/Commit/Push/Merge/Clone)、治疗型(Pull/Revert)、特殊型(Rebase/Reset/Branch/Stash/Cherry Pick)。
+
+【输出要求】
+- 输出15-30字短句
+- 用中文，口语化，有情绪
+
+你可以自由选择任何话题和角度进行解说，不受限制。"""
+    
+    # 构建用户提示词（完整上下文）
+    # 使用所有事件，不限制数量
+    user_prompt = '【事件】'
+    for event in events:
+        event_text = event_to_text(event)
+        if event_text:
+            user_prompt += f" {event_text};"
+    
+    if game_state:
+        summary = get_game_state_summary(game_state)
+        user_prompt += f"\n【战况】玩家{summary['playerHealth']}HP 对手{summary['opponentHealth']}HP 第{summary['turnNumber']}回合"
+        
+        # 关键状态
+        critical = []
+        if summary['playerHealth'] <= 30:
+            critical.append('玩家血量告急')
+        if summary['opponentHealth'] <= 30:
+            critical.append('对手血量告急')
+        if summary.get('playerBuffs'):
+            buff_names = [b.get('name', '') for b in summary['playerBuffs']]
+            if buff_names:
+                critical.append(f"玩家有buff:{','.join(buff_names)}")
+        if summary.get('opponentBuffs'):
+            buff_names = [b.get('name', '') for b in summary['opponentBuffs']]
+            if buff_names:
+                critical.append(f"对手有buff:{','.join(buff_names)}")
+        if critical:
+            user_prompt += f" {' '.join(critical)}"
+        
+        # 手牌信息（完整信息，包括卡牌类型、消耗、效果等）
+        player_hand = summary.get('playerHand', [])
+        opponent_hand = summary.get('opponentHand', [])
+        
+        if player_hand:
+            hand_cards = []
+            for c in player_hand:
+                card_info = f"{c.get('icon', '')}{c.get('name', '')}"
+                card_type = c.get('type', '')
+                cost = c.get('cost', 0)
+                power = c.get('power', 0)
+                heal = c.get('heal', 0)
+                draw = c.get('draw', 0)
+                effects = []
+                if card_type:
+                    effects.append(f"类型:{card_type}")
+                if cost > 0:
+                    effects.append(f"消耗:{cost}")
+                if power > 0:
+                    effects.append(f"伤害{power}")
+                if heal > 0:
+                    effects.append(f"治疗{heal}")
+                if draw > 0:
+                    effects.append(f"抽{draw}张")
+                if effects:
+                    card_info += f"({','.join(effects)})"
+                hand_cards.append(card_info)
+            user_prompt += f"\n【玩家手牌】{','.join(hand_cards)}"
+        
+        if opponent_hand:
+            hand_cards = []
+            for c in opponent_hand:
+                card_info = f"{c.get('icon', '')}{c.get('name', '')}"
+                card_type = c.get('type', '')
+                cost = c.get('cost', 0)
+                power = c.get('power', 0)
+                heal = c.get('heal', 0)
+                draw = c.get('draw', 0)
+                effects = []
+                if card_type:
+                    effects.append(f"类型:{card_type}")
+                if cost > 0:
+                    effects.append(f"消耗:{cost}")
+                if power > 0:
+                    effects.append(f"伤害{power}")
+                if heal > 0:
+                    effects.append(f"治疗{heal}")
+                if draw > 0:
+                    effects.append(f"抽{draw}张")
+                if effects:
+                    card_info += f"({','.join(effects)})"
+                hand_cards.append(card_info)
+            user_prompt += f"\n【对手手牌】{','.join(hand_cards)}"
+    
+    user_prompt += '\n【输出】15-30字短句。'
+    
+    return [
+        {
+            "role": "system",
+            "content": system_prompt
+        },
+        {
+            "role": "user",
+            "content": user_prompt
+        }
+    ]
+
+
 # 辅助函数：将事件转换为文本
 def event_to_text(event):
     """将事件转换为文本描述"""
@@ -615,7 +615,8 @@ export class Game {
         // 记录事件
         this.commentator.recordEvent('card_played', { 
             player: 'player', 
-            card: { name: card.name, icon: card.icon, type: card.type } 
+            card: { name: card.name, icon: card.icon, type: card.type },
+            turnNumber: this.gameState.turnNumber
         });
 
         // 先触发手牌退出动画（如果有对应DOM），等动画结束后再重新排列手牌
@@ -884,7 +885,8 @@ export class Game {
             // 记录对手出牌事件
             this.commentator.recordEvent('card_played', { 
                 player: 'opponent', 
-                card: { name: card.name, icon: card.icon, type: card.type } 
+                card: { name: card.name, icon: card.icon, type: card.type },
+                turnNumber: this.gameState.turnNumber
             });
 
             // 播放出牌音效